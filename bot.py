@@ -1,10 +1,11 @@
 import asyncio
 import logging
 import os
-from typing import List, Set
-from io import BytesIO
+import re
+from typing import FrozenSet, List, Optional, Set
+from html import escape
 
-from telegram import Update
+from telegram import Document, Message, Update
 from telegram.constants import ChatType, ParseMode
 from telegram.ext import Application, CommandHandler, ContextTypes, MessageHandler, filters
 
@@ -18,7 +19,7 @@ logging.basicConfig(
 logger = logging.getLogger("code-distributor-bot")
 
 
-def _parse_admin_ids(raw: str) -> Set[int]:
+def _parse_admin_ids(raw: str) -> FrozenSet[int]:
 	ids: Set[int] = set()
 	for chunk in raw.split(","):
 		chunk = chunk.strip()
@@ -28,11 +29,11 @@ def _parse_admin_ids(raw: str) -> Set[int]:
 			ids.add(int(chunk))
 		except ValueError:
 			logger.warning("Ignoring invalid admin id: %s", chunk)
-	return ids
+	return frozenset(ids)
 
 
 BOT_TOKEN = os.environ.get("TELEGRAM_BOT_TOKEN", "").strip()
-ADMIN_IDS: Set[int] = _parse_admin_ids(os.environ.get("ADMIN_IDS", ""))
+ADMIN_IDS: FrozenSet[int] = _parse_admin_ids(os.environ.get("ADMIN_IDS", ""))
 DB_PATH = os.environ.get("DB_PATH", "codes.db").strip() or "codes.db"
 
 if not BOT_TOKEN:
@@ -48,24 +49,55 @@ def _is_admin(user_id: int) -> bool:
 	return user_id in ADMIN_IDS
 
 
+# Sent for every distributed code; only the (escaped) code value varies
+_DIST_TMPL = "兑换码：\n<code>{}</code>"
+
+_UPLOAD_SUMMARY_TMPL = "上传成功：新增 {inserted} 条｜忽略重复 {duplicates} 条｜剩余未使用 {remaining} 条"
+
+# Codes are separated by newlines (any convention) and/or commas
+_CODE_SEPARATORS = re.compile(r"[,\r\n]+")
+
+
 def _extract_codes_from_text(text: str) -> List[str]:
-	# Normalize newlines
-	text = text.replace("\r\n", "\n").replace("\r", "\n")
-	results: List[str] = []
-	seen = set()
-	for raw_line in text.split("\n"):
-		line = raw_line.strip()
-		if not line:
-			continue
-		# Support comma-separated values on a single line as well
-		parts = [p.strip() for p in line.split(",")]
-		for p in parts:
-			if not p:
-				continue
-			if p not in seen:
-				seen.add(p)
-				results.append(p)
-	return results
+	# dict.fromkeys de-duplicates while preserving upload order
+	parts = (p.strip() for p in _CODE_SEPARATORS.split(text))
+	return list(dict.fromkeys(p for p in parts if p))
+
+
+async def _download_text(doc: Document) -> str:
+	"""Download a text document straight into bytes and decode it."""
+	file = await doc.get_file()
+	data = await file.download_as_bytearray()
+	try:
+		return data.decode("utf-8")
+	except UnicodeDecodeError:
+		return data.decode("latin-1", errors="ignore")
+
+
+async def _codes_from_message(msg: Message) -> Optional[List[str]]:
+	"""
+	Extract codes from a text message or a text document.
+	Returns None if the message is neither plain text nor a .txt/text/* document.
+	"""
+	if msg.text and not msg.text.startswith("/"):
+		return _extract_codes_from_text(msg.text)
+	doc = msg.document
+	if doc is None:
+		return None
+	is_text_mime = (doc.mime_type or "").startswith("text/")
+	is_txt_ext = (doc.file_name or "").lower().endswith(".txt")
+	if not (is_text_mime or is_txt_ext):
+		return None
+	return _extract_codes_from_text(await _download_text(doc))
+
+
+async def _store_codes_and_report(update: Update, uploaded_by: int, codes: List[str]) -> None:
+	"""Insert uploaded codes and reply with the upload summary."""
+	inserted, duplicates = await storage.insert_codes(codes=codes, uploaded_by=uploaded_by)
+	remaining = storage.unused_count
+	await update.effective_chat.send_message(
+		_UPLOAD_SUMMARY_TMPL.format(inserted=inserted, duplicates=duplicates, remaining=remaining)
+	)
 
 
 async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -100,31 +132,8 @@ async def handle_private_upload(update: Update, context: ContextTypes.DEFAULT_TY
 		await update.effective_chat.send_message("无权限。")
 		return
 
-	# Record/refresh admin display name & username
-	await storage.upsert_user(user_id=user.id, display_name=getattr(user, "full_name", user.first_name or ""), username=user.username)
-
-	codes: List[str] = []
-	# Text upload
-	if message.text:
-		codes = _extract_codes_from_text(message.text)
-	# Text document upload (.txt or text/*)
-	elif message.document:
-		doc = message.document
-		is_text_mime = (doc.mime_type or "").startswith("text/")
-		is_txt_ext = (doc.file_name or "").lower().endswith(".txt")
-		if not (is_text_mime or is_txt_ext):
-			await update.effective_chat.send_message("请上传 .txt 文件或发送纯文本。")
-			return
-		file = await doc.get_file()
-		buffer = BytesIO()
-		await file.download_to_memory(out=buffer)
-		data = buffer.getvalue()
-		try:
-			text = data.decode("utf-8")
-		except UnicodeDecodeError:
-			text = data.decode("latin-1", errors="ignore")
-		codes = _extract_codes_from_text(text)
-	else:
+	codes = await _codes_from_message(message)
+	if codes is None:
 		await update.effective_chat.send_message("发送文本或 .txt 文件（每行一个兑换码）。")
 		return
 
@@ -132,29 +141,27 @@ async def handle_private_upload(update: Update, context: ContextTypes.DEFAULT_TY
 		await update.effective_chat.send_message("未在消息中找到兑换码。")
 		return
 
-	inserted, duplicates = await storage.insert_codes(codes=codes, uploaded_by=user.id)
-	remaining = await storage.count_unused()
-	await update.effective_chat.send_message(
-		f"上传成功：新增 {inserted} 条｜忽略重复 {duplicates} 条｜剩余未使用 {remaining} 条"
-	)
+	await _store_codes_and_report(update, user.id, codes)
 
 
 async def cmd_distribute(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 	user = update.effective_user
 	if user is None:
 		return
-	
-	# Record/refresh user display name & username (for any user now)
-	await storage.upsert_user(user_id=user.id, display_name=getattr(user, "full_name", user.first_name or ""), username=user.username)
 
-	code_value = await storage.get_and_mark_next_unused(used_by=user.id)
+	# The recipient's display name & username are refreshed in the same write
+	code_value = await storage.get_and_mark_next_unused(
+		used_by=user.id,
+		display_name=getattr(user, "full_name", user.first_name or ""),
+		username=user.username,
+	)
 	if code_value is None:
 		await update.effective_chat.send_message("没有可用的兑换码，请先上传。")
 		return
 
-	# Render the code in monospaced formatting
+	# Render the code in monospaced formatting; escape so "<", "&" etc. can't break the HTML
 	await update.effective_chat.send_message(
-		f"兑换码：\n<code>{code_value}</code>",
+		_DIST_TMPL.format(escape(code_value)),
 		parse_mode=ParseMode.HTML,
 		disable_web_page_preview=True,
 	)
@@ -165,7 +172,7 @@ async def cmd_remaining(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
 	if user is None:
 		return
 	# No admin check - allow all users to see remaining count
-	remaining = await storage.count_unused()
+	remaining = storage.unused_count
 	await update.effective_chat.send_message(f"剩余未使用：{remaining} 条")
 
 
@@ -219,26 +226,8 @@ async def cmd_upload(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
 		return
 
 	msg = update.effective_message.reply_to_message
-	codes: List[str] = []
-	if msg.text and not msg.text.startswith("/"):
-		codes = _extract_codes_from_text(msg.text)
-	elif msg.document:
-		doc = msg.document
-		is_text_mime = (doc.mime_type or "").startswith("text/")
-		is_txt_ext = (doc.file_name or "").lower().endswith(".txt")
-		if not (is_text_mime or is_txt_ext):
-			await update.effective_chat.send_message("请回复 .txt 文件或纯文本消息。")
-			return
-		file = await doc.get_file()
-		buffer = BytesIO()
-		await file.download_to_memory(out=buffer)
-		data = buffer.getvalue()
-		try:
-			text = data.decode("utf-8")
-		except UnicodeDecodeError:
-			text = data.decode("latin-1", errors="ignore")
-		codes = _extract_codes_from_text(text)
-	else:
+	codes = await _codes_from_message(msg)
+	if codes is None:
 		await update.effective_chat.send_message("不支持的消息类型。请回复文本或 .txt 文件。")
 		return
 
@@ -246,11 +235,7 @@ async def cmd_upload(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
 		await update.effective_chat.send_message("未在被回复的消息中找到兑换码。")
 		return
 
-	inserted, duplicates = await storage.insert_codes(codes=codes, uploaded_by=user.id)
-	remaining = await storage.count_unused()
-	await update.effective_chat.send_message(
-		f"上传成功：新增 {inserted} 条｜忽略重复 {duplicates} 条｜剩余未使用 {remaining} 条"
-	)
+	await _store_codes_and_report(update, user.id, codes)
 
 
 async def cmd_reset(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -282,6 +267,10 @@ async def handle_chinese_commands(update: Update, context: ContextTypes.DEFAULT_
 		await cmd_usage(update, context)
 
 
+async def _on_shutdown(app: Application) -> None:
+	await storage.close()
+
+
 def main() -> None:
 	# Create and set an event loop explicitly (Python 3.13 compatibility)
 	loop = asyncio.new_event_loop()
@@ -289,25 +278,37 @@ def main() -> None:
 	# Initialize storage (async) before starting the bot
 	loop.run_until_complete(storage.initialize())
 
-	app = Application.builder().token(BOT_TOKEN).build()
+	# Process updates concurrently so a slow upload in one chat doesn't stall others.
+	# Storage serializes its own writes, so handlers are safe to interleave.
+	app = (
+		Application.builder()
+		.token(BOT_TOKEN)
+		.concurrent_updates(True)
+		.post_shutdown(_on_shutdown)
+		.build()
+	)
 
 	# Commands
-	app.add_handler(CommandHandler("start", cmd_start))
-	app.add_handler(CommandHandler("help", cmd_help))
+	app.add_handler(CommandHandler("start", cmd_start, block=False))
+	app.add_handler(CommandHandler("help", cmd_help, block=False))
 	app.add_handler(CommandHandler("fa", cmd_distribute, filters=filters.ChatType.GROUPS))
-	app.add_handler(CommandHandler("yuliang", cmd_remaining))
-	app.add_handler(CommandHandler("yongliang", cmd_usage))
-	app.add_handler(CommandHandler("shangchuan", cmd_upload))
-	app.add_handler(CommandHandler("chongzhi", cmd_reset))
+	app.add_handler(CommandHandler("yuliang", cmd_remaining, block=False))
+	app.add_handler(CommandHandler("yongliang", cmd_usage, block=False))
+	# Admin-only handlers: non-admin updates are dropped by the filter before a handler
+	# is scheduled; the in-handler _is_admin checks remain as defense in depth.
+	admin_filter = filters.User(user_id=ADMIN_IDS)
+	app.add_handler(CommandHandler("shangchuan", cmd_upload, filters=admin_filter))
+	app.add_handler(CommandHandler("chongzhi", cmd_reset, filters=admin_filter))
 	
 	# Chinese word commands (work in groups and private)
 	chinese_filter = filters.TEXT & ~filters.COMMAND
 	app.add_handler(MessageHandler(chinese_filter, handle_chinese_commands))
 
-	# Private chat uploads: text or .txt documents (admin only via existing handler)
-	private_text_filter = filters.ChatType.PRIVATE & filters.TEXT & ~filters.COMMAND
+	# Private chat uploads: text or .txt documents (admin only)
+	private_text_filter = admin_filter & filters.ChatType.PRIVATE & filters.TEXT & ~filters.COMMAND
 	private_doc_filter = (
-		filters.ChatType.PRIVATE
+		admin_filter
+		& filters.ChatType.PRIVATE
 		& (filters.Document.MimeType("text/plain") | filters.Document.FileExtension("txt"))
 	)
 	app.add_handler(MessageHandler(private_text_filter, handle_private_upload))
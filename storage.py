@@ -1,20 +1,169 @@
 import asyncio
+from contextlib import asynccontextmanager
 from datetime import datetime, timezone
-from typing import List, Optional, Tuple
+from typing import AsyncIterator, Iterator, List, Optional, Sequence, Tuple
 
 import aiosqlite
 
 
+# Fixed statements. Executing the same SQL text every call lets each connection's
+# sqlite3 statement cache (128 entries by default, ample for this module) reuse
+# the prepared statement instead of re-parsing it.
+
+# An upload is bulk-loaded into a per-connection temp table, one bound column per row,
+# then copied into codes by a single set-based INSERT ... SELECT in rowid (upload) order.
+# The UNIQUE index is still probed once per row; what goes away is the per-row binding
+# of uploaded_by/uploaded_at and the per-row INSERT OR IGNORE statement steps.
+_SQL_CREATE_STAGING = "CREATE TEMP TABLE IF NOT EXISTS upload_staging (code TEXT NOT NULL);"
+_SQL_STAGE_CODE = "INSERT INTO upload_staging (code) VALUES (?);"
+_SQL_INSERT_STAGED = """
+	INSERT OR IGNORE INTO codes (code, is_used, uploaded_by, uploaded_at)
+	SELECT code, 0, ?, ? FROM upload_staging ORDER BY rowid;
+"""
+_SQL_CLEAR_STAGING = "DELETE FROM upload_staging;"
+
+# Single statement: the pick and the mark happen atomically (requires SQLite >= 3.35)
+_SQL_MARK_NEXT_USED = """
+	UPDATE codes SET is_used = 1, used_by = ?, used_at = ?
+	WHERE id = (SELECT id FROM codes WHERE is_used = 0 ORDER BY id ASC LIMIT 1)
+	RETURNING code;
+"""
+_SQL_COUNT_UNUSED = "SELECT COUNT(*) FROM codes WHERE is_used = 0;"
+# Per-user running totals, bumped in the same transaction that marks a code used.
+# The recipient's current name rides along so the leaderboard needs no join.
+_SQL_BUMP_USER_STATS = """
+	INSERT INTO user_stats (user_id, used_total, used_today, used_date, display_name, username)
+	VALUES (?, 1, 1, ?, ?, ?)
+	ON CONFLICT(user_id) DO UPDATE SET
+		used_total = used_total + 1,
+		used_today = CASE WHEN used_date = excluded.used_date THEN used_today + 1 ELSE 1 END,
+		used_date = excluded.used_date,
+		display_name = excluded.display_name,
+		username = excluded.username;
+"""
+_SQL_COUNT_USED_BY = "SELECT used_total FROM user_stats WHERE user_id = ?;"
+_SQL_USAGE_COUNTS = """
+	SELECT user_id, used_total
+	FROM user_stats
+	WHERE used_total > 0
+	ORDER BY used_total DESC;
+"""
+_SQL_USAGE_WITH_NAMES = """
+	SELECT user_id, display_name, username, used_total
+	FROM user_stats
+	WHERE used_total > 0
+	ORDER BY used_total DESC;
+"""
+_SQL_USAGE_WITH_NAMES_TODAY = """
+	SELECT user_id, display_name, username, used_today
+	FROM user_stats
+	WHERE used_date = ? AND used_today > 0
+	ORDER BY used_today DESC;
+"""
+_SQL_TOTAL_USED = "SELECT COALESCE(SUM(used_total), 0) FROM user_stats;"
+_SQL_TOTAL_USED_TODAY = "SELECT COALESCE(SUM(used_today), 0) FROM user_stats WHERE used_date = ?;"
+
+# Upper bound on rows the upload flusher folds into one transaction; a single
+# upload larger than this is still written whole
+_FLUSH_MAX_ROWS = 5000
+
+# Rows bound per executemany call, so a huge upload never materializes all of its
+# parameter tuples at once; every chunk still commits in the same transaction
+_INSERT_CHUNK_ROWS = 5000
+
+# Read-only connections serving the statistics queries alongside the single writer
+_READER_COUNT = 4
+
+# (unique codes, uploaded_by, uploaded_at, future resolved with the inserted count)
+_PendingUpload = Tuple[List[str], int, str, "asyncio.Future[int]"]
+
+
+_UTC = timezone.utc
+
+
+def _now_iso() -> str:
+	"""Current UTC time as ISO 8601 to the second; the first 10 chars are the UTC date."""
+	return datetime.now(_UTC).isoformat(timespec="seconds")
+
+
 class Storage:
 	"""Async SQLite storage for codes with single-use distribution."""
 
 	def __init__(self, db_path: str = "codes.db") -> None:
 		self.db_path = db_path
 		self._lock = asyncio.Lock()
+		# One writer connection (serialized by self._lock) plus a pool of read-only
+		# connections; under WAL, readers never wait for the writer
+		self._writer: Optional[aiosqlite.Connection] = None
+		self._readers: "asyncio.Queue[aiosqlite.Connection]" = asyncio.Queue()
+		self._reader_conns: List[aiosqlite.Connection] = []
+		# Unused-code count kept in step with every write path, so reads need no SQL
+		self._unused = 0
+		# Uploads are queued and written by a single background flusher
+		self._upload_q: "asyncio.Queue[_PendingUpload]" = asyncio.Queue()
+		self._flusher: Optional["asyncio.Task[None]"] = None
+
+	@property
+	def _write_conn(self) -> aiosqlite.Connection:
+		if self._writer is None:
+			raise RuntimeError("Storage is not initialized; await initialize() first.")
+		return self._writer
+
+	@asynccontextmanager
+	async def _reader(self) -> AsyncIterator[aiosqlite.Connection]:
+		"""Borrow a read-only connection from the pool for the duration of the block."""
+		if self._writer is None:
+			raise RuntimeError("Storage is not initialized; await initialize() first.")
+		db = await self._readers.get()
+		try:
+			yield db
+		finally:
+			self._readers.put_nowait(db)
+
+	@asynccontextmanager
+	async def _write_txn(self) -> AsyncIterator[aiosqlite.Connection]:
+		"""
+		Run the block as one transaction on the writer connection, committing on success.
+		Any error rolls it back, so nothing stays pending for the next writer to commit.
+		"""
+		async with self._lock:  # Writers share one connection, so their transactions must not interleave
+			db = self._write_conn
+			await db.execute("BEGIN IMMEDIATE;")
+			try:
+				yield db
+				await db.commit()
+			except BaseException:
+				await db.rollback()
+				raise
+
+	async def _open_connection(self, query_only: bool) -> aiosqlite.Connection:
+		"""Open a connection and apply the per-connection pragmas."""
+		db = await aiosqlite.connect(self.db_path)
+		await db.execute("PRAGMA synchronous=NORMAL;")
+		# Wait for a competing writer's lock instead of failing with SQLITE_BUSY
+		await db.execute("PRAGMA busy_timeout=5000;")
+		# Keep temp b-trees (sorts, GROUP BY) in memory instead of temp files
+		await db.execute("PRAGMA temp_store=MEMORY;")
+		# ~64 MB page cache (negative values are KiB) so hot pages stay resident
+		await db.execute("PRAGMA cache_size=-64000;")
+		# Memory-map up to 256 MB of the database so reads skip read() syscalls
+		await db.execute("PRAGMA mmap_size=268435456;")
+		if query_only:
+			await db.execute("PRAGMA query_only=1;")
+		return db
 
 	async def initialize(self) -> None:
-		"""Create database schema if it doesn't exist."""
-		async with aiosqlite.connect(self.db_path) as db:
+		"""Open the writer and reader connections and create database schema if it doesn't exist."""
+		if self._writer is None:
+			self._writer = await self._open_connection(query_only=False)
+		db = self._writer
+		# WAL lets the readers proceed while the writer commits. journal_mode is
+		# persistent in the database file, so the writer sets it once for everyone.
+		await db.execute("PRAGMA journal_mode=WAL;")
+		# Schema and the one-time user_stats seed run in one explicit transaction. DDL is
+		# transactional in SQLite, so a crash before the commit also undoes CREATE TABLE
+		# and the seed runs again on the next start instead of leaving an empty table.
+		async with self._write_txn() as db:
 			await db.execute(
 				"""
 				CREATE TABLE IF NOT EXISTS codes (
@@ -28,6 +177,8 @@ class Storage:
 				);
 				"""
 			)
+			# No longer written: names live on user_stats. Kept so that databases from
+			# before user_stats can seed those names from it below.
 			await db.execute(
 				"""
 				CREATE TABLE IF NOT EXISTS users (
@@ -38,7 +189,73 @@ class Storage:
 				);
 				"""
 			)
-			await db.commit()
+			# Partial index over unused rows only: keeps the FIFO pick and the unused
+			# count proportional to remaining codes rather than to all codes ever stored
+			await db.execute(
+				"CREATE INDEX IF NOT EXISTS idx_codes_unused ON codes(id) WHERE is_used = 0;"
+			)
+			# Per-user running totals so the usage statistics read O(users) rows rather than
+			# aggregating every used code. Seeded from codes the first time it is created.
+			async with db.execute(
+				"SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'user_stats';"
+			) as cursor:
+				has_user_stats = await cursor.fetchone() is not None
+			if not has_user_stats:
+				await db.execute(
+					"""
+					CREATE TABLE user_stats (
+						user_id INTEGER PRIMARY KEY,
+						used_total INTEGER NOT NULL DEFAULT 0,
+						used_today INTEGER NOT NULL DEFAULT 0,
+						used_date TEXT,
+						display_name TEXT,
+						username TEXT
+					);
+					"""
+				)
+				# used_at is UTC ISO 8601, so its first 10 characters are the UTC date.
+				# Names come from users once here; after that each distribution keeps them.
+				today = _now_iso()[:10]
+				await db.execute(
+					"""
+					INSERT INTO user_stats (user_id, used_total, used_today, used_date, display_name, username)
+					SELECT c.used_by, COUNT(*), SUM(substr(c.used_at, 1, 10) = ?), ?, u.display_name, u.username
+					FROM codes c
+					LEFT JOIN users u ON u.user_id = c.used_by
+					WHERE c.is_used = 1 AND c.used_by IS NOT NULL
+					GROUP BY c.used_by;
+					""",
+					(today, today),
+				)
+			await db.execute(_SQL_CREATE_STAGING)
+		async with db.execute(_SQL_COUNT_UNUSED) as cursor:
+			row = await cursor.fetchone()
+			self._unused = int(row[0]) if row is not None else 0
+		while len(self._reader_conns) < _READER_COUNT:
+			reader = await self._open_connection(query_only=True)
+			self._reader_conns.append(reader)
+			self._readers.put_nowait(reader)
+		if self._flusher is None:
+			self._flusher = asyncio.create_task(self._flush_uploads())
+
+	async def close(self) -> None:
+		"""Stop the upload flusher and close all connections. Safe to call more than once."""
+		if self._flusher is not None:
+			flusher, self._flusher = self._flusher, None
+			flusher.cancel()
+			try:
+				await flusher
+			except asyncio.CancelledError:
+				pass
+		while not self._upload_q.empty():
+			_fail_uploads([self._upload_q.get_nowait()], RuntimeError("Storage was closed."))
+		readers, self._reader_conns = self._reader_conns, []
+		self._readers = asyncio.Queue()
+		for reader in readers:
+			await reader.close()
+		if self._writer is not None:
+			db, self._writer = self._writer, None
+			await db.close()
 
 	async def insert_codes(self, codes: List[str], uploaded_by: int) -> Tuple[int, int]:
 		"""
@@ -47,219 +264,165 @@ class Storage:
 		Returns (inserted_count, duplicate_or_ignored_count)
 		"""
 		# De-duplicate within the incoming batch while preserving order
-		seen = set()
-		unique_codes: List[str] = []
-		for c in codes:
-			if c not in seen:
-				seen.add(c)
-				unique_codes.append(c)
-
-		now_iso = datetime.now(timezone.utc).isoformat()
-		async with aiosqlite.connect(self.db_path) as db:
-			# Sensible pragmas for WAL mode to reduce write contention
-			await db.execute("PRAGMA journal_mode=WAL;")
-			await db.execute("PRAGMA synchronous=NORMAL;")
-			for code in unique_codes:
-				await db.execute(
-					"""
-					INSERT OR IGNORE INTO codes (code, is_used, uploaded_by, uploaded_at)
-					VALUES (?, 0, ?, ?);
-					""",
-					(code, uploaded_by, now_iso),
-				)
-			await db.commit()
+		unique_codes: List[str] = list(dict.fromkeys(codes))
 
-			# Count how many were inserted in this batch using the timestamp marker
-			async with db.execute(
-				"SELECT COUNT(*) FROM codes WHERE uploaded_at = ? AND uploaded_by = ?;",
-				(now_iso, uploaded_by),
-			) as cursor:
-				row = await cursor.fetchone()
-				inserted_count = int(row[0]) if row is not None else 0
+		if not unique_codes:
+			return 0, 0
+		if self._flusher is None:
+			raise RuntimeError("Storage is not initialized; await initialize() first.")
+
+		now_iso = _now_iso()
+		future: "asyncio.Future[int]" = asyncio.get_running_loop().create_future()
+		await self._upload_q.put((unique_codes, uploaded_by, now_iso, future))
+		inserted_count = await future
 
 		duplicates = max(len(unique_codes) - inserted_count, 0)
 		return inserted_count, duplicates
 
+	async def _flush_uploads(self) -> None:
+		"""
+		Background task draining the upload queue.
+		Uploads that queued up while the previous flush ran are written together in one
+		transaction (bounded by _FLUSH_MAX_ROWS); each caller's future gets its own count.
+		"""
+		while True:
+			batch = [await self._upload_q.get()]
+			rows = len(batch[0][0])
+			while rows < _FLUSH_MAX_ROWS and not self._upload_q.empty():
+				item = self._upload_q.get_nowait()
+				batch.append(item)
+				rows += len(item[0])
+			try:
+				counts = await self._write_uploads(batch)
+			except asyncio.CancelledError:
+				_fail_uploads(batch, RuntimeError("Storage was closed."))
+				raise
+			except Exception as exc:
+				_fail_uploads(batch, exc)
+				continue
+			for (_, _, _, future), count in zip(batch, counts):
+				if not future.done():
+					future.set_result(count)
+
+	async def _write_uploads(self, batch: List[_PendingUpload]) -> List[int]:
+		"""Insert every queued upload in one transaction; returns per-upload inserted counts."""
+		counts: List[int] = []
+		# One transaction for the whole batch: a single lock acquisition and fsync
+		async with self._write_txn() as db:
+			for codes, uploaded_by, now_iso, _ in batch:
+				for chunk in _chunked(codes, _INSERT_CHUNK_ROWS):
+					await db.executemany(_SQL_STAGE_CODE, [(code,) for code in chunk])
+				# ORDER BY rowid keeps ids in upload order for the FIFO pick; ignored
+				# duplicates do not count towards rowcount
+				async with db.execute(_SQL_INSERT_STAGED, (uploaded_by, now_iso)) as cursor:
+					counts.append(max(cursor.rowcount, 0))
+				await db.execute(_SQL_CLEAR_STAGING)
+		self._unused += sum(counts)
+		return counts
+
+	@property
+	def unused_count(self) -> int:
+		"""Number of unused codes, maintained in memory by the write paths."""
+		return self._unused
+
 	async def count_unused(self) -> int:
-		async with aiosqlite.connect(self.db_path) as db:
-			async with db.execute("SELECT COUNT(*) FROM codes WHERE is_used = 0;") as cursor:
-				row = await cursor.fetchone()
-				return int(row[0]) if row is not None else 0
+		return self._unused
 
-	async def get_and_mark_next_unused(self, used_by: int) -> Optional[str]:
+	async def get_and_mark_next_unused(
+		self, used_by: int, display_name: Optional[str], username: Optional[str]
+	) -> Optional[str]:
 		"""
 		Atomically fetch the next unused code (FIFO) and mark it as used.
+		The recipient's display name and username are recorded with their usage totals.
 		Returns the code string, or None if none remain.
 		"""
-		async with self._lock:  # Extra guard to minimize concurrent pick attempts
-			async with aiosqlite.connect(self.db_path) as db:
-				await db.execute("PRAGMA journal_mode=WAL;")
-				await db.execute("PRAGMA synchronous=NORMAL;")
-				# Start a write transaction to avoid races
-				await db.execute("BEGIN IMMEDIATE;")
-
-				code_row = None
-				async with db.execute(
-					"SELECT id, code FROM codes WHERE is_used = 0 ORDER BY id ASC LIMIT 1;"
-				) as cursor:
-					code_row = await cursor.fetchone()
-
-				if code_row is None:
-					await db.commit()
-					return None
-
-				code_id, code_value = int(code_row[0]), str(code_row[1])
-				now_iso = datetime.now(timezone.utc).isoformat()
-				await db.execute(
-					"UPDATE codes SET is_used = 1, used_by = ?, used_at = ? WHERE id = ? AND is_used = 0;",
-					(used_by, now_iso, code_id),
-				)
-				await db.commit()
-				return code_value
+		now_iso = _now_iso()
+		today = now_iso[:10]
+		async with self._write_txn() as db:
+			async with db.execute(_SQL_MARK_NEXT_USED, (used_by, now_iso)) as cursor:
+				row = await cursor.fetchone()
+			if row is not None:
+				await db.execute(_SQL_BUMP_USER_STATS, (used_by, today, display_name, username))
+		if row is None:
+			return None
+		self._unused -= 1
+		return str(row[0])
 
 	async def count_used_by(self, user_id: int) -> int:
 		"""Return how many codes were distributed by the given user id."""
-		async with aiosqlite.connect(self.db_path) as db:
-			async with db.execute(
-				"SELECT COUNT(*) FROM codes WHERE is_used = 1 AND used_by = ?;",
-				(user_id,),
-			) as cursor:
+		async with self._reader() as db:
+			async with db.execute(_SQL_COUNT_USED_BY, (user_id,)) as cursor:
 				row = await cursor.fetchone()
 				return int(row[0]) if row is not None else 0
 
 	async def usage_counts(self) -> List[Tuple[int, int]]:
 		"""Return a list of (used_by, count) for all users who distributed codes."""
-		async with aiosqlite.connect(self.db_path) as db:
-			async with db.execute(
-				"""
-				SELECT used_by, COUNT(*)
-				FROM codes
-				WHERE is_used = 1 AND used_by IS NOT NULL
-				GROUP BY used_by
-				ORDER BY COUNT(*) DESC;
-				"""
-			) as cursor:
+		async with self._reader() as db:
+			async with db.execute(_SQL_USAGE_COUNTS) as cursor:
 				rows = await cursor.fetchall()
-				results: List[Tuple[int, int]] = []
-				for r in rows:
-					if r[0] is None:
-						continue
-					results.append((int(r[0]), int(r[1])))
-				return results
-
-	async def upsert_user(self, user_id: int, display_name: str, username: Optional[str]) -> None:
-		"""Insert or update a user's display name and username."""
-		now_iso = datetime.now(timezone.utc).isoformat()
-		async with aiosqlite.connect(self.db_path) as db:
-			await db.execute(
-				"""
-				INSERT INTO users (user_id, display_name, username, updated_at)
-				VALUES (?, ?, ?, ?)
-				ON CONFLICT(user_id) DO UPDATE SET
-					display_name = excluded.display_name,
-					username = excluded.username,
-					updated_at = excluded.updated_at;
-				""",
-				(user_id, display_name, username, now_iso),
-			)
-			await db.commit()
+		# user_stats columns are typed (user_id is the rowid), so rows need no conversion
+		return [(r[0], r[1]) for r in rows]
 
 	async def usage_counts_with_names(self) -> List[Tuple[int, Optional[str], Optional[str], int]]:
 		"""Return list of (user_id, display_name, username, count)."""
-		async with aiosqlite.connect(self.db_path) as db:
-			async with db.execute(
-				"""
-				SELECT c.used_by, u.display_name, u.username, COUNT(*) as cnt
-				FROM codes c
-				LEFT JOIN users u ON u.user_id = c.used_by
-				WHERE c.is_used = 1 AND c.used_by IS NOT NULL
-				GROUP BY c.used_by, u.display_name, u.username
-				ORDER BY cnt DESC;
-				"""
-			) as cursor:
+		async with self._reader() as db:
+			async with db.execute(_SQL_USAGE_WITH_NAMES) as cursor:
 				rows = await cursor.fetchall()
-				results: List[Tuple[int, Optional[str], Optional[str], int]] = []
-				for r in rows:
-					uid = int(r[0]) if r[0] is not None else 0
-					dname = str(r[1]) if r[1] is not None else None
-					uname = str(r[2]) if r[2] is not None else None
-					cnt = int(r[3])
-					results.append((uid, dname, uname, cnt))
-				return results
+		return [(r[0], r[1], r[2], r[3]) for r in rows]
 
 	async def usage_counts_with_names_today(self) -> List[Tuple[int, Optional[str], Optional[str], int]]:
 		"""Return list of (user_id, display_name, username, count) for current UTC day."""
-		async with aiosqlite.connect(self.db_path) as db:
-			async with db.execute(
-				"""
-				SELECT c.used_by, u.display_name, u.username, COUNT(*) as cnt
-				FROM codes c
-				LEFT JOIN users u ON u.user_id = c.used_by
-				WHERE c.is_used = 1 AND c.used_by IS NOT NULL AND date(c.used_at) = date('now')
-				GROUP BY c.used_by, u.display_name, u.username
-				ORDER BY cnt DESC;
-				"""
-			) as cursor:
+		# Today's date is bound as a parameter rather than computed by date('now') in SQL
+		today = _now_iso()[:10]
+		async with self._reader() as db:
+			async with db.execute(_SQL_USAGE_WITH_NAMES_TODAY, (today,)) as cursor:
 				rows = await cursor.fetchall()
-				results: List[Tuple[int, Optional[str], Optional[str], int]] = []
-				for r in rows:
-					uid = int(r[0]) if r[0] is not None else 0
-					dname = str(r[1]) if r[1] is not None else None
-					uname = str(r[2]) if r[2] is not None else None
-					cnt = int(r[3])
-					results.append((uid, dname, uname, cnt))
-				return results
+		return [(r[0], r[1], r[2], r[3]) for r in rows]
 
 	async def total_used_count(self) -> int:
-		async with aiosqlite.connect(self.db_path) as db:
-			async with db.execute("SELECT COUNT(*) FROM codes WHERE is_used = 1;") as cursor:
+		async with self._reader() as db:
+			async with db.execute(_SQL_TOTAL_USED) as cursor:
 				row = await cursor.fetchone()
 				return int(row[0]) if row is not None else 0
 
 	async def total_used_today(self) -> int:
-		async with aiosqlite.connect(self.db_path) as db:
-			async with db.execute(
-				"SELECT COUNT(*) FROM codes WHERE is_used = 1 AND date(used_at) = date('now');"
-			) as cursor:
+		# Today's date is bound as a parameter rather than computed by date('now') in SQL
+		today = _now_iso()[:10]
+		async with self._reader() as db:
+			async with db.execute(_SQL_TOTAL_USED_TODAY, (today,)) as cursor:
 				row = await cursor.fetchone()
 				return int(row[0]) if row is not None else 0
 
 	async def reset_all_codes(self) -> Tuple[int, int]:
 		"""Reset all codes to unused. Returns (reset_count, total_unused_after)."""
-		async with self._lock:
-			async with aiosqlite.connect(self.db_path) as db:
-				await db.execute("PRAGMA journal_mode=WAL;")
-				await db.execute("PRAGMA synchronous=NORMAL;")
-				await db.execute("BEGIN IMMEDIATE;")
-				# Count used codes
-				async with db.execute("SELECT COUNT(*) FROM codes WHERE is_used = 1;") as cur:
-					row = await cur.fetchone()
-					used_count = int(row[0]) if row else 0
-				# Reset them
-				await db.execute(
-					"UPDATE codes SET is_used = 0, used_by = NULL, used_at = NULL WHERE is_used = 1;"
-				)
-				await db.commit()
-				# Count total unused after
-				async with db.execute("SELECT COUNT(*) FROM codes WHERE is_used = 0;") as cur2:
-					row2 = await cur2.fetchone()
-					unused_total = int(row2[0]) if row2 else 0
-				return used_count, unused_total
+		async with self._write_txn() as db:
+			# Reset used codes; the statement's rowcount is how many there were
+			async with db.execute(
+				"UPDATE codes SET is_used = 0, used_by = NULL, used_at = NULL WHERE is_used = 1;"
+			) as cur:
+				used_count = max(cur.rowcount, 0)
+			# No code counts as distributed any more
+			await db.execute("DELETE FROM user_stats;")
+		self._unused += used_count
+		return used_count, self._unused
 
 	async def clear_all_codes(self) -> int:
 		"""Delete all codes from storage. Returns number of rows removed."""
-		async with self._lock:
-			async with aiosqlite.connect(self.db_path) as db:
-				await db.execute("PRAGMA journal_mode=WAL;")
-				await db.execute("PRAGMA synchronous=NORMAL;")
-				await db.execute("BEGIN IMMEDIATE;")
-				# Count total rows first
-				async with db.execute("SELECT COUNT(*) FROM codes;") as cur:
-					row = await cur.fetchone()
-					total = int(row[0]) if row else 0
-				# Delete all
-				await db.execute("DELETE FROM codes;")
-				await db.commit()
-				return total
+		async with self._write_txn() as db:
+			# Delete all; the statement's rowcount is how many there were
+			async with db.execute("DELETE FROM codes;") as cur:
+				total = max(cur.rowcount, 0)
+			await db.execute("DELETE FROM user_stats;")
+		self._unused = 0
+		return total
+
+
+def _fail_uploads(batch: List[_PendingUpload], exc: BaseException) -> None:
+	for _, _, _, future in batch:
+		if not future.done():
+			future.set_exception(exc)
 
 
+def _chunked(items: Sequence[str], size: int) -> Iterator[Sequence[str]]:
+	for start in range(0, len(items), size):
+		yield items[start:start + size]